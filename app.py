@@ -1,11 +1,17 @@
+import heapq
 import io
+import json
 import os
 import shutil
 import time
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice
 from pathlib import Path
-from threading import Lock, Thread
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
 from uuid import uuid4
 
 DEFAULT_PW_PATH = "/ms-playwright"
@@ -15,48 +21,126 @@ if "PLAYWRIGHT_BROWSERS_PATH" not in os.environ:
         DEFAULT_PW_PATH if Path(DEFAULT_PW_PATH).exists() else FALLBACK_PW_PATH
     )
 
-from flask import Flask, jsonify, redirect, render_template, request, send_file, session, url_for
+from flask import Flask, Response, jsonify, redirect, render_template, request, session, url_for
 from authlib.integrations.flask_client import OAuth
-from playwright.sync_api import sync_playwright
-
-from download_traces import ensure_playwright_browsers, read_suppliers, run
+from download_traces import BrowserPool, ensure_playwright_browsers, read_suppliers, run
 
 
 APP_ROOT = Path(__file__).resolve().parent
 RUNS_DIR = APP_ROOT / "web_runs"
 ZIP_TTL_SECONDS = 24 * 60 * 60
 MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# PDFs are already compressed internally; a fast deflate level costs ~1% in size.
+ZIP_COMPRESS_LEVEL = 1
+DEFAULT_WORKERS = 1
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "2"))
+MAX_WORKERS = 4
 ALLOWED_MIME_TYPES = {
     "text/csv",
     "application/csv",
     "application/vnd.ms-excel",
     "text/plain",
 }
-JOBS: dict[str, dict] = {}
-JOBS_LOCK = Lock()
+EVENT_HEARTBEAT_SECONDS = 15
+MAX_LOG_LINES = 500
+FINAL_STATUSES = {"done", "error", "cancelled"}
+JOB_STRIPE_COUNT = 16
+# Jobs beyond MAX_CONCURRENT_JOBS wait in the executor queue instead of
+# each launching its own set of browsers.
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix="job")
+# One warm browser thread per possible parallel worker; each closes its
+# Chromium after BROWSER_IDLE_SECONDS without work.
+BROWSER_IDLE_SECONDS = int(os.environ.get("BROWSER_IDLE_SECONDS", "600"))
+BROWSER_POOL = BrowserPool(MAX_CONCURRENT_JOBS * MAX_WORKERS, idle_seconds=BROWSER_IDLE_SECONDS)
+# (expires_at, job_id, run_dir) min-heap driving cleanup_loop.
+EXPIRY_HEAP: list[tuple[float, str, str]] = []
+EXPIRY_LOCK = Lock()
+CLEANUP_WAKE = Event()
+
+
+class JobStripe:
+    """One shard of the job registry; unrelated jobs hash to different locks."""
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.jobs: dict[str, dict] = {}
+        self.subscribers: dict[str, list[Queue]] = {}
+
+
+JOB_STRIPES = [JobStripe() for _ in range(JOB_STRIPE_COUNT)]
+
+
+def job_stripe(job_id: str) -> JobStripe:
+    return JOB_STRIPES[hash(job_id) % JOB_STRIPE_COUNT]
+
+
+class ZipStreamBuffer(io.RawIOBase):
+    """Write-only sink that lets zipfile emit an archive chunk by chunk."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: list[bytes] = []
 
+    def writable(self) -> bool:
+        return True
 
-def create_zip_file(source_dir: Path, zip_path: Path) -> None:
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
-        for path in sorted(source_dir.rglob("*")):
-            if path.is_file():
-                zf.write(path, path.relative_to(source_dir))
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_files(directory: str):
+    # DirEntry type checks reuse the d_type from readdir instead of a stat per entry.
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+def iter_zip_chunks(source_dir: Path):
+    buffer = ZipStreamBuffer()
+    files = sorted(iter_files(str(source_dir)), key=lambda entry: entry.path)
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESS_LEVEL) as zf:
+        for entry in files:
+            compress_type = zipfile.ZIP_STORED if entry.name.lower().endswith(".pdf") else zipfile.ZIP_DEFLATED
+            zf.write(entry.path, os.path.relpath(entry.path, source_dir), compress_type=compress_type)
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+def publish_event(stripe: JobStripe, job_id: str, event: dict) -> None:
+    # Callers hold stripe.lock.
+    for queue in stripe.subscribers.get(job_id, ()):
+        queue.put_nowait(event)
 
 
 def update_job(job_id: str, **updates) -> None:
-    with JOBS_LOCK:
-        job = JOBS.get(job_id)
+    stripe = job_stripe(job_id)
+    with stripe.lock:
+        job = stripe.jobs.get(job_id)
         if not job:
             return
         job.update(updates)
+        publish_event(stripe, job_id, {"type": "update", **updates})
 
 
 def append_log(job_id: str, message: str) -> None:
-    with JOBS_LOCK:
-        job = JOBS.get(job_id)
+    stripe = job_stripe(job_id)
+    with stripe.lock:
+        job = stripe.jobs.get(job_id)
         if not job:
             return
         job["logs"].append(message)
+        job["log_seq"] += 1
+        publish_event(stripe, job_id, {"type": "log", "message": message, "seq": job["log_seq"]})
 
 
 app = Flask(__name__)
@@ -87,38 +171,50 @@ def login_required(fn):
     return wrapper
 
 
-def cleanup_runs() -> None:
-    cutoff = time.time() - ZIP_TTL_SECONDS
-    if not RUNS_DIR.exists():
+def schedule_expiry(job_id: str, run_dir: Path, expires_at: float) -> None:
+    with EXPIRY_LOCK:
+        heapq.heappush(EXPIRY_HEAP, (expires_at, job_id, str(run_dir)))
+    CLEANUP_WAKE.set()
+
+
+def expire_run(job_id: str, run_dir: str) -> None:
+    shutil.rmtree(run_dir, ignore_errors=True)
+    if not job_id:
         return
-    for run_dir in RUNS_DIR.iterdir():
-        if not run_dir.is_dir():
-            continue
-        try:
-            mtime = run_dir.stat().st_mtime
-        except OSError:
-            continue
-        if mtime < cutoff:
-            shutil.rmtree(run_dir, ignore_errors=True)
+    stripe = job_stripe(job_id)
+    with stripe.lock:
+        stripe.jobs.pop(job_id, None)
+        stripe.subscribers.pop(job_id, None)
+
 
-    with JOBS_LOCK:
-        stale_ids = []
-        for job_id, job in JOBS.items():
-            zip_path = Path(job.get("zip_path", ""))
+def schedule_existing_runs() -> None:
+    # Runs left behind by a previous process have no job entry; expire them by mtime.
+    if not RUNS_DIR.exists():
+        return
+    with os.scandir(RUNS_DIR) as entries:
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
             try:
-                mtime = zip_path.stat().st_mtime
+                mtime = entry.stat(follow_symlinks=False).st_mtime
             except OSError:
-                mtime = 0
-            if mtime and mtime < cutoff:
-                stale_ids.append(job_id)
-        for job_id in stale_ids:
-            JOBS.pop(job_id, None)
+                continue
+            schedule_expiry("", Path(entry.path), mtime + ZIP_TTL_SECONDS)
 
 
 def cleanup_loop() -> None:
+    schedule_existing_runs()
     while True:
-        cleanup_runs()
-        time.sleep(60 * 60)
+        with EXPIRY_LOCK:
+            CLEANUP_WAKE.clear()
+            delay = EXPIRY_HEAP[0][0] - time.time() if EXPIRY_HEAP else None
+            if delay is not None and delay <= 0:
+                _, job_id, run_dir = heapq.heappop(EXPIRY_HEAP)
+        if delay is None or delay > 0:
+            # Sleep until the next expiry, or until schedule_expiry adds one.
+            CLEANUP_WAKE.wait(delay)
+            continue
+        expire_run(job_id, run_dir)
 
 
 Thread(target=cleanup_loop, daemon=True).start()
@@ -147,7 +243,8 @@ def download():
     job_dir.mkdir(parents=True, exist_ok=True)
 
     csv_path = job_dir / "suppliers.csv"
-    upload.save(csv_path)
+    with csv_path.open("wb") as dst:
+        shutil.copyfileobj(upload.stream, dst, UPLOAD_CHUNK_BYTES)
 
     try:
         delay_seconds = int(request.form.get("delay_seconds", "10"))
@@ -157,31 +254,46 @@ def download():
         timeout_ms = int(request.form.get("timeout_ms", "15000"))
     except ValueError:
         timeout_ms = 15000
+    try:
+        workers = int(request.form.get("workers", str(DEFAULT_WORKERS)))
+    except ValueError:
+        workers = DEFAULT_WORKERS
+    workers = max(1, min(workers, MAX_WORKERS))
 
     job_id = uuid4().hex
     out_dir = job_dir / "downloads"
-    zip_path = job_dir / "traces_pdfs.zip"
 
-    with JOBS_LOCK:
-        JOBS[job_id] = {
-            "status": "running",
+    stripe = job_stripe(job_id)
+    with stripe.lock:
+        stripe.jobs[job_id] = {
+            "status": "queued",
             "current": 0,
             "total": 0,
             "ok": 0,
             "error": None,
-            "logs": [],
-            "zip_path": str(zip_path),
+            "logs": deque(maxlen=MAX_LOG_LINES),
+            "log_seq": 0,
+            "out_dir": str(out_dir),
             "cancel": False,
         }
+    schedule_expiry(job_id, job_dir, time.time() + ZIP_TTL_SECONDS)
 
     def worker() -> None:
+        def should_cancel() -> bool:
+            with stripe.lock:
+                job = stripe.jobs.get(job_id)
+                return bool(job and job.get("cancel"))
+
         try:
+            if should_cancel():
+                update_job(job_id, status="cancelled")
+                return
             suppliers = read_suppliers(csv_path)
             if not suppliers:
                 update_job(job_id, status="error", error="No suppliers found in the CSV.")
                 return
 
-            update_job(job_id, total=len(suppliers))
+            update_job(job_id, status="running", total=len(suppliers))
 
             def on_message(message: str) -> None:
                 append_log(job_id, message)
@@ -189,24 +301,20 @@ def download():
             def on_progress(current: int, total: int, ok: int) -> None:
                 update_job(job_id, current=current, total=total, ok=ok)
 
-            def should_cancel() -> bool:
-                with JOBS_LOCK:
-                    job = JOBS.get(job_id)
-                    return bool(job and job.get("cancel"))
-
             ensure_playwright_browsers()
-            with sync_playwright() as playwright:
-                run(
-                    playwright=playwright,
-                    suppliers=suppliers,
-                    out_dir=out_dir,
-                    headed=False,
-                    timeout_ms=timeout_ms,
-                    delay_seconds=delay_seconds,
-                    on_message=on_message,
-                    on_progress=on_progress,
-                    should_cancel=should_cancel,
-                )
+            run(
+                playwright=None,
+                suppliers=suppliers,
+                out_dir=out_dir,
+                headed=False,
+                timeout_ms=timeout_ms,
+                delay_seconds=delay_seconds,
+                on_message=on_message,
+                on_progress=on_progress,
+                should_cancel=should_cancel,
+                workers=workers,
+                browser_pool=BROWSER_POOL,
+            )
 
             if not out_dir.exists():
                 update_job(job_id, status="error", error="No downloads were created.")
@@ -215,56 +323,106 @@ def download():
             if should_cancel():
                 update_job(job_id, status="cancelled")
                 return
-            create_zip_file(out_dir, zip_path)
             update_job(job_id, status="done")
         except Exception as exc:
             update_job(job_id, status="error", error=str(exc))
 
-    Thread(target=worker, daemon=True).start()
+    JOB_EXECUTOR.submit(worker)
     return render_template("index.html", job_id=job_id, error=None)
 
 
 @app.get("/status/<job_id>")
 @login_required
 def status(job_id: str):
-    with JOBS_LOCK:
-        job = JOBS.get(job_id)
+    since = request.args.get("since", 0, type=int)
+    stripe = job_stripe(job_id)
+    with stripe.lock:
+        job = stripe.jobs.get(job_id)
         if not job:
             return jsonify({"status": "missing"}), 404
-        return jsonify(job)
+        logs = job["logs"]
+        # Only send the lines the client has not seen yet (log_seq counts every line ever logged).
+        new_count = min(max(job["log_seq"] - since, 0), len(logs))
+        payload = {**job, "logs": list(islice(logs, len(logs) - new_count, None))}
+    return jsonify(payload)
+
+
+@app.get("/events/<job_id>")
+@login_required
+def events(job_id: str):
+    queue: Queue = Queue()
+    stripe = job_stripe(job_id)
+    with stripe.lock:
+        job = stripe.jobs.get(job_id)
+        if not job:
+            return jsonify({"status": "missing"}), 404
+        snapshot = {**job, "logs": list(job["logs"])}
+        stripe.subscribers.setdefault(job_id, []).append(queue)
+
+    def stream():
+        try:
+            yield f"data: {json.dumps({'type': 'snapshot', **snapshot})}\n\n"
+            if snapshot["status"] in FINAL_STATUSES:
+                return
+            while True:
+                try:
+                    event = queue.get(timeout=EVENT_HEARTBEAT_SECONDS)
+                except Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield f"data: {json.dumps(event)}\n\n"
+                if event.get("status") in FINAL_STATUSES:
+                    return
+        finally:
+            with stripe.lock:
+                subscribers = stripe.subscribers.get(job_id, [])
+                if queue in subscribers:
+                    subscribers.remove(queue)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.post("/cancel/<job_id>")
 @login_required
 def cancel(job_id: str):
-    with JOBS_LOCK:
-        job = JOBS.get(job_id)
+    stripe = job_stripe(job_id)
+    with stripe.lock:
+        job = stripe.jobs.get(job_id)
         if not job:
             return jsonify({"status": "missing"}), 404
-        if job["status"] != "running":
+        if job["status"] not in {"queued", "running"}:
             return jsonify({"status": job["status"]}), 400
         job["cancel"] = True
+        if job["status"] == "queued":
+            # Nothing has started yet; the worker's own cancel check will just return.
+            job["status"] = "cancelled"
+            publish_event(stripe, job_id, {"type": "update", "status": "cancelled"})
+            return jsonify({"status": "cancelled"})
     return jsonify({"status": "cancelling"})
 
 
 @app.get("/result/<job_id>")
 @login_required
 def result(job_id: str):
-    with JOBS_LOCK:
-        job = JOBS.get(job_id)
+    stripe = job_stripe(job_id)
+    with stripe.lock:
+        job = stripe.jobs.get(job_id)
         if not job:
             return "Job not found", 404
         if job["status"] != "done":
             return "Job not finished", 400
-        zip_path = Path(job["zip_path"])
-    if not zip_path.exists():
-        return "ZIP not found", 404
+        out_dir = Path(job["out_dir"])
+    if not out_dir.exists():
+        return "Downloads not found", 404
     zip_name = f"traces_pdfs_{job_id}.zip"
-    return send_file(
-        zip_path,
+    return Response(
+        iter_zip_chunks(out_dir),
         mimetype="application/zip",
-        as_attachment=True,
-        download_name=zip_name,
+        headers={"Content-Disposition": f"attachment; filename={zip_name}"},
     )
 
 
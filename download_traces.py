@@ -2,10 +2,14 @@ import argparse
 import csv
 import os
 import re
+import shutil
 import subprocess
 import sys
 import time
-from urllib.parse import quote_plus
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Empty, LifoQueue, Queue
+from threading import Lock, Thread
+from urllib.parse import quote
 from pathlib import Path
 from typing import Callable
 import errno
@@ -17,18 +21,39 @@ if "PLAYWRIGHT_BROWSERS_PATH" not in os.environ:
         DEFAULT_PW_PATH if Path(DEFAULT_PW_PATH).exists() else FALLBACK_PW_PATH
     )
 
-from playwright.sync_api import Playwright, sync_playwright, TimeoutError as PWTimeoutError
+from playwright.sync_api import Browser, Error as PWError, Playwright, sync_playwright, TimeoutError as PWTimeoutError
 
 
 BASE_URL = "https://webgate.ec.europa.eu/tracesnt/directory/publication/organic-operator/index"
 BROWSERS_PATH = Path(os.environ.get("PLAYWRIGHT_BROWSERS_PATH", "")).expanduser()
+# Set once Chromium is known to be installed so later jobs skip the directory scan.
+BROWSERS_READY = False
+# URL patterns (images, fonts, media, analytics) never needed to find a certificate link.
+BLOCKED_URL_PATTERNS = [
+    *(f"*.{ext}*" for ext in ("png", "jpg", "jpeg", "gif", "svg", "webp", "ico")),
+    *(f"*.{ext}*" for ext in ("woff", "woff2", "ttf", "otf", "eot")),
+    *(f"*.{ext}*" for ext in ("mp4", "webm", "mp3")),
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+]
+# Characters encodeURIComponent leaves alone beyond the ones quote() already keeps.
+SEARCH_QUERY_SAFE = "!*'()"
+HEADER_VALUES = {"supplier", "suppliers", "name", "names"}
+SLUG_INVALID_RE = re.compile(r"[^\w\-]+")
+SLUG_UNDERSCORES_RE = re.compile(r"_+")
+# ASCII fast path for slugify: same result as SLUG_INVALID_RE, without the regex engine.
+SLUG_ASCII_TABLE = str.maketrans(
+    {c: "_" for c in map(chr, range(128)) if not (c.isalnum() or c in "_-")}
+)
 
 
 def ensure_playwright_browsers() -> None:
-    if not BROWSERS_PATH:
+    global BROWSERS_READY
+    if BROWSERS_READY or not BROWSERS_PATH:
         return
     chromium_glob = BROWSERS_PATH.glob("chromium-*/chrome-linux/chrome")
     if any(chromium_glob):
+        BROWSERS_READY = True
         return
     BROWSERS_PATH.mkdir(parents=True, exist_ok=True)
     lock_path = BROWSERS_PATH / ".install.lock"
@@ -41,6 +66,7 @@ def ensure_playwright_browsers() -> None:
             pass
         # Another worker might have installed while we waited on the lock.
         if any(BROWSERS_PATH.glob("chromium-*/chrome-linux/chrome")):
+            BROWSERS_READY = True
             return
         for attempt in range(3):
             try:
@@ -49,6 +75,7 @@ def ensure_playwright_browsers() -> None:
                     check=True,
                     env={**os.environ, "PLAYWRIGHT_BROWSERS_PATH": str(BROWSERS_PATH)},
                 )
+                BROWSERS_READY = True
                 return
             except OSError as exc:
                 if exc.errno == errno.ETXTBSY and attempt < 2:
@@ -57,17 +84,59 @@ def ensure_playwright_browsers() -> None:
                 raise
 
 
+def block_nonessential_requests(context, page) -> None:
+    # Block in Chromium itself rather than with context.route(): routing disables
+    # the HTTP cache and sends every request through a Python callback.
+    cdp = context.new_cdp_session(page)
+    cdp.send("Network.enable")
+    cdp.send("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+
+
 def slugify(value: str) -> str:
     value = value.strip().lower()
-    value = re.sub(r"[^\w\-]+", "_", value)
-    value = re.sub(r"_+", "_", value).strip("_")
+    if value.isascii():
+        value = value.translate(SLUG_ASCII_TABLE)
+    else:
+        value = SLUG_INVALID_RE.sub("_", value)
+    value = SLUG_UNDERSCORES_RE.sub("_", value).strip("_")
     return value or "unknown"
 
 
+def read_suppliers_arrow(csv_path: Path) -> list[str] | None:
+    # Column-at-a-time parse for large UTF-8 files. Returns None when pyarrow is
+    # unavailable or the file needs the csv module (other encodings, ragged rows).
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        from pyarrow import csv as pa_csv
+    except ImportError:
+        return None
+    try:
+        table = pa_csv.read_csv(
+            csv_path,
+            read_options=pa_csv.ReadOptions(autogenerate_column_names=True),
+            parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={"f0": pa.string()},
+                include_columns=["f0"],
+                strings_can_be_null=False,
+            ),
+        )
+    except pa.ArrowInvalid:
+        return None
+    column = pc.utf8_trim_whitespace(table.column(0))
+    is_header = pc.is_in(pc.utf8_lower(column), value_set=pa.array(sorted(HEADER_VALUES)))
+    keep = pc.and_(pc.not_equal(column, ""), pc.invert(is_header))
+    return column.filter(keep).to_pylist()
+
+
 def read_suppliers(csv_path: Path) -> list[str]:
     if not csv_path.exists():
         raise FileNotFoundError(f"Suppliers CSV not found: {csv_path}")
-    suppliers: list[str] = []
+    suppliers = read_suppliers_arrow(csv_path)
+    if suppliers is not None:
+        return suppliers
+    suppliers = []
     last_error: Exception | None = None
     for encoding in ("utf-8-sig", "utf-8", "cp1252", "latin-1"):
         try:
@@ -80,7 +149,7 @@ def read_suppliers(csv_path: Path) -> list[str]:
                     value = row[0].strip()
                     if not value:
                         continue
-                    if value.lower() in {"supplier", "suppliers", "name", "names"}:
+                    if value.lower() in HEADER_VALUES:
                         continue
                     suppliers.append(value)
             return suppliers
@@ -104,7 +173,25 @@ def first_visible(locator):
     return None
 
 
-def find_search_input(page):
+def find_first_visible(page, candidates: list[str], selector_cache: dict[str, str] | None, key: str):
+    # Try the selector that matched last time on this page before scanning every candidate.
+    cached = selector_cache.get(key) if selector_cache is not None else None
+    if cached:
+        item = first_visible(page.locator(cached))
+        if item:
+            return item
+    for selector in candidates:
+        if selector == cached:
+            continue
+        item = first_visible(page.locator(selector))
+        if item:
+            if selector_cache is not None:
+                selector_cache[key] = selector
+            return item
+    return None
+
+
+def find_search_input(page, selector_cache: dict[str, str] | None = None):
     candidates = [
         "input#search",
         "input[name='search']",
@@ -112,32 +199,113 @@ def find_search_input(page):
         "input[type='search']",
         "input[type='text']",
     ]
-    for selector in candidates:
-        loc = page.locator(selector)
-        item = first_visible(loc)
-        if item:
-            return item
-    return None
+    return find_first_visible(page, candidates, selector_cache, "search_input")
 
 
-def find_search_button(page):
+def find_search_button(page, selector_cache: dict[str, str] | None = None):
     candidates = [
         "button:has-text('Search')",
         "input[type='submit']",
         "button[type='submit']",
     ]
-    for selector in candidates:
-        loc = page.locator(selector)
-        item = first_visible(loc)
-        if item:
-            return item
-    return None
+    return find_first_visible(page, candidates, selector_cache, "search_button")
 
 
 def normalize_text(value: str) -> str:
     return re.sub(r"[^a-z0-9]+", "", value.lower())
 
 
+# Tags everything that could be read as a search result: the result rows, their
+# buttons/links, and any element whose own text is an empty-result message.
+MARK_RESULTS_STALE_JS = """
+() => {
+  const noResults = /no (results|records|data)/i;
+  for (const row of document.querySelectorAll("tbody tr")) {
+    row.setAttribute("data-stale", "1");
+    row.querySelectorAll("button, a").forEach((el) => el.setAttribute("data-stale", "1"));
+  }
+  for (const el of document.querySelectorAll("td, div, p, span, li")) {
+    const ownText = Array.from(el.childNodes)
+      .filter((node) => node.nodeType === Node.TEXT_NODE)
+      .map((node) => node.textContent)
+      .join(" ");
+    if (noResults.test(ownText)) {
+      el.setAttribute("data-stale", "1");
+    }
+  }
+}
+"""
+
+# Marks the current results as stale and points the search hash at a new
+# query. Returns false when an in-place search is not safe: the page is not on
+# the search view, a dialog is still open, or the hash would not change.
+SET_SEARCH_HASH_JS = """
+(query) => {
+  if (!location.hash.startsWith("#!?")) {
+    return false;
+  }
+  const dialogs = document.querySelectorAll("[role='dialog'], [aria-modal='true'], .modal");
+  if (Array.from(dialogs).some((el) => el.getClientRects().length > 0)) {
+    return false;
+  }
+  const hash = "#!?query=" + encodeURIComponent(query) + "&sort=-issuedOn";
+  if (location.hash === hash) {
+    return false;
+  }
+  (MARK_RESULTS_STALE)();
+  location.hash = hash;
+  return true;
+}
+""".replace("MARK_RESULTS_STALE", MARK_RESULTS_STALE_JS.strip())
+
+# True once nothing tagged stale is still rendered (removed or hidden).
+STALE_RESULTS_GONE_JS = (
+    "() => !Array.from(document.querySelectorAll('[data-stale]'))"
+    ".some((el) => el.getClientRects().length > 0)"
+)
+CLEAR_STALE_JS = "() => document.querySelectorAll('[data-stale]').forEach((el) => el.removeAttribute('data-stale'))"
+# An in-place search that has not replaced the old results by now is cheaper to
+# redo with a reload than to keep waiting on.
+IN_PLACE_SEARCH_TIMEOUT_MS = 5000
+
+
+def search_in_place(page, query: str, timeout_ms: int) -> bool:
+    # The directory is a single-page app, so once it is loaded a new search only
+    # needs a hash change. Returns False when the caller must reload instead.
+    if not page.url.startswith(BASE_URL):
+        return False
+    if not page.evaluate(SET_SEARCH_HASH_JS, query):
+        return False
+    try:
+        page.wait_for_function(STALE_RESULTS_GONE_JS, timeout=min(timeout_ms, IN_PLACE_SEARCH_TIMEOUT_MS))
+    except PWTimeoutError:
+        # Old results were not replaced; never read them as this query's results.
+        return False
+    return True
+
+
+# Returns the index (among all <tr> elements) of the first row that matches the
+# supplier and has a View button, in a single round trip; -1 when none does.
+# The row text is normalised the same way as normalize_text.
+FIND_ROW_INDEX_JS = """
+(supplierNorm) => {
+  const rows = document.querySelectorAll("tr");
+  for (let i = 0; i < rows.length; i++) {
+    const text = (rows[i].innerText || "").toLowerCase().replace(/[^a-z0-9]+/g, "");
+    if (!text.includes(supplierNorm)) {
+      continue;
+    }
+    for (const el of rows[i].querySelectorAll("button, a")) {
+      if ((el.innerText || el.textContent || "").toLowerCase().includes("view")) {
+        return i;
+      }
+    }
+  }
+  return -1;
+}
+"""
+
+
 def handle_cookie_banner(page) -> None:
     candidates = [
         "button:has-text('Accept')",
@@ -157,7 +325,13 @@ def handle_cookie_banner(page) -> None:
             break
 
 
-def download_pdf_for_supplier(page, supplier: str, out_dir: Path, timeout_ms: int) -> bool:
+def download_pdf_for_supplier(
+    page,
+    supplier: str,
+    out_dir: Path,
+    timeout_ms: int,
+    selector_cache: dict[str, str] | None = None,
+) -> bool:
     queries = [supplier]
     if "ß" in supplier:
         alt = supplier.replace("ß", "ss")
@@ -165,51 +339,59 @@ def download_pdf_for_supplier(page, supplier: str, out_dir: Path, timeout_ms: in
             queries.append(alt)
 
     view_selector = "button:has-text('View'), a:has-text('View')"
+    results_selector = (
+        "button:has-text('View'):not([data-stale]):visible, "
+        "a:has-text('View'):not([data-stale]):visible, "
+        ":text-matches('no (results|records|data)', 'i'):not([data-stale]):visible"
+    )
     for query in queries:
-        search_url = f"{BASE_URL}#!?query={quote_plus(query)}&sort=-issuedOn"
-        page.goto(search_url, wait_until="domcontentloaded")
-        handle_cookie_banner(page)
-
-        # If the query param didn't bind for any reason, fall back to manual search.
-        search_input = find_search_input(page)
-        if search_input:
+        if not search_in_place(page, query, timeout_ms):
+            # Encoded like encodeURIComponent so SET_SEARCH_HASH_JS can spot a repeat query.
+            search_url = f"{BASE_URL}#!?query={quote(query, safe=SEARCH_QUERY_SAFE)}&sort=-issuedOn"
+            if page.url.startswith(BASE_URL):
+                # A goto that only changes the hash stays in the same document;
+                # leave it first so the fallback really starts from a clean page.
+                page.goto("about:blank")
+            page.goto(search_url, wait_until="domcontentloaded")
+            handle_cookie_banner(page)
+
+        # If the query param didn't bind for any reason, fall back to a single
+        # manual search and wait for it to replace whatever rows are showing.
+        search_input = find_search_input(page, selector_cache)
+        if search_input and search_input.input_value().strip() != query.strip():
+            page.evaluate(MARK_RESULTS_STALE_JS)
             search_input.fill(query)
-            try:
-                search_input.press("Enter")
-            except Exception:
-                pass
-            search_button = find_search_button(page)
+            search_button = find_search_button(page, selector_cache)
             if search_button:
                 search_button.click()
+            else:
+                search_input.press("Enter")
+            try:
+                page.wait_for_function(STALE_RESULTS_GONE_JS, timeout=timeout_ms)
+            except PWTimeoutError:
+                # What is still showing came from this query's URL or hash search,
+                # so it may be read as this query's results.
+                page.evaluate(CLEAR_STALE_JS)
+        # Wait for the results themselves (or an empty-result message) rather
+        # than for the network to go idle.
         try:
-            page.wait_for_load_state("networkidle", timeout=timeout_ms)
-        except PWTimeoutError:
-            pass
-
-        try:
-            page.wait_for_selector(view_selector, timeout=timeout_ms)
+            page.wait_for_selector(results_selector, timeout=timeout_ms)
         except PWTimeoutError:
             continue
+        if page.locator(view_selector).count() == 0:
+            continue
 
         view_button = None
         supplier_norm = normalize_text(query)
-        rows = page.locator("tr")
-        try:
-            row_count = rows.count()
-        except Exception:
-            row_count = 0
-
-        for i in range(row_count):
+        if supplier_norm:
             try:
-                row = rows.nth(i)
-                row_text = row.inner_text()
-                if supplier_norm and supplier_norm in normalize_text(row_text):
-                    candidate = row.locator(view_selector).first
-                    if candidate.count() > 0:
-                        view_button = candidate
-                        break
+                row_index = page.evaluate(FIND_ROW_INDEX_JS, supplier_norm)
             except Exception:
-                continue
+                row_index = -1
+            if row_index >= 0:
+                # A locator re-resolves on click, so a re-rendered table does not
+                # leave us holding a detached element.
+                view_button = page.locator("tr").nth(row_index).locator(view_selector).first
 
         if view_button is None:
             view_button = page.locator(view_selector).first
@@ -232,12 +414,87 @@ def download_pdf_for_supplier(page, supplier: str, out_dir: Path, timeout_ms: in
     download = download_info.value
     suggested = download.suggested_filename or "certificate.pdf"
     target_path = out_dir / f"{safe_name}__{suggested}"
-    download.save_as(target_path)
+    # Move Playwright's finished artifact into place instead of copying it.
+    try:
+        artifact = download.path()
+    except PWError:
+        # path() is unavailable e.g. for remote browsers; save_as() still works there.
+        download.save_as(target_path)
+    else:
+        shutil.move(artifact, target_path)
     return True
 
 
+class BrowserWorker(Thread):
+    """Thread that keeps one Chromium warm and runs browser tasks on it."""
+
+    def __init__(self, headless: bool, idle_seconds: float) -> None:
+        super().__init__(name="browser-worker", daemon=True)
+        self.headless = headless
+        self.idle_seconds = idle_seconds
+        self.tasks: Queue = Queue()
+
+    def submit(self, fn: Callable[[Browser], None]) -> Future:
+        future: Future = Future()
+        self.tasks.put((fn, future))
+        return future
+
+    def run(self) -> None:
+        # Playwright's sync API is bound to the thread that started it, so the
+        # driver and browser are created, used and closed on this thread only.
+        playwright = None
+        browser = None
+        while True:
+            try:
+                fn, future = self.tasks.get(timeout=self.idle_seconds if playwright else None)
+            except Empty:
+                # Idle for a while: free the driver and Chromium until the next job.
+                try:
+                    if browser is not None:
+                        browser.close()
+                    playwright.stop()
+                except Exception:
+                    pass
+                playwright = browser = None
+                continue
+            try:
+                if playwright is None:
+                    playwright = sync_playwright().start()
+                if browser is None or not browser.is_connected():
+                    browser = playwright.chromium.launch(headless=self.headless)
+                future.set_result(fn(browser))
+            except Exception as exc:
+                future.set_exception(exc)
+
+
+class BrowserPool:
+    """Fixed set of BrowserWorkers shared by every job in the process."""
+
+    def __init__(self, size: int, headless: bool = True, idle_seconds: float = 600) -> None:
+        # LIFO so jobs reuse the most recently warmed browsers and the rest idle out.
+        self.idle: LifoQueue = LifoQueue()
+        for _ in range(size):
+            worker = BrowserWorker(headless, idle_seconds)
+            worker.start()
+            self.idle.put(worker)
+
+    def acquire(self, count: int) -> list[BrowserWorker]:
+        # Wait for one worker, then take as many more as are free right now.
+        workers = [self.idle.get()]
+        while len(workers) < count:
+            try:
+                workers.append(self.idle.get_nowait())
+            except Empty:
+                break
+        return workers
+
+    def release(self, workers: list[BrowserWorker]) -> None:
+        for worker in workers:
+            self.idle.put(worker)
+
+
 def run(
-    playwright: Playwright,
+    playwright: Playwright | None,
     suppliers: list[str],
     out_dir: Path,
     headed: bool,
@@ -246,43 +503,109 @@ def run(
     on_message: Callable[[str], None] | None = None,
     on_progress: Callable[[int, int, int], None] | None = None,
     should_cancel: Callable[[], bool] | None = None,
+    workers: int = 1,
+    browser_pool: BrowserPool | None = None,
 ):
-    browser = playwright.chromium.launch(headless=not headed)
-    context = browser.new_context(accept_downloads=True)
-    page = context.new_page()
-
     total = len(suppliers)
-    ok = 0
+    workers = max(1, min(workers, total))
+    lock = Lock()
+    state = {"next": 0, "done": 0, "ok": 0, "cancelled": False}
 
     def log(message: str) -> None:
         print(message)
         if on_message:
             on_message(message)
 
-    for i, supplier in enumerate(suppliers, start=1):
-        if should_cancel and should_cancel():
-            log("  -> cancelled")
-            break
-        log(f"[{i}/{total}] {supplier}")
+    def next_supplier() -> tuple[int, str] | None:
+        with lock:
+            if state["next"] >= total:
+                return None
+            state["next"] += 1
+            return state["next"], suppliers[state["next"] - 1]
+
+    def work(worker_browser: Browser, worker_index: int) -> None:
+        # Playwright's sync API is bound to the thread that started it, so
+        # every worker drives its own browser and page.
+        context = worker_browser.new_context(accept_downloads=True)
+        page = context.new_page()
+        block_nonessential_requests(context, page)
+        selector_cache: dict[str, str] = {}
+        first = True
         try:
-            success = download_pdf_for_supplier(page, supplier, out_dir, timeout_ms)
-            if success:
-                ok += 1
-                log("  -> downloaded")
-            else:
-                log("  -> not found")
-        except PWTimeoutError:
-            log("  -> timeout")
+            while True:
+                item = next_supplier()
+                if item is None:
+                    break
+                # Stagger the workers' first searches across one delay period.
+                pause = worker_index * delay_seconds / workers if first else delay_seconds
+                if pause > 0:
+                    time.sleep(pause)
+                first = False
+                if should_cancel and should_cancel():
+                    state["cancelled"] = True
+                    break
+                i, supplier = item
+                with lock:
+                    log(f"[{i}/{total}] {supplier}")
+                success = False
+                try:
+                    success = download_pdf_for_supplier(page, supplier, out_dir, timeout_ms, selector_cache)
+                    outcome = "downloaded" if success else "not found"
+                except PWTimeoutError:
+                    outcome = "timeout"
+                except Exception as exc:
+                    outcome = f"error: {exc}"
+                with lock:
+                    state["done"] += 1
+                    if success:
+                        state["ok"] += 1
+                    # Name the supplier again when other workers may have logged in between.
+                    log(f"  -> {outcome}" if workers == 1 else f"  -> {outcome} ({supplier})")
+                    if on_progress:
+                        on_progress(state["done"], total, state["ok"])
+        finally:
+            context.close()
+
+    def work_in_thread(worker_index: int) -> None:
+        try:
+            with sync_playwright() as pw:
+                worker_browser = pw.chromium.launch(headless=not headed)
+                try:
+                    work(worker_browser, worker_index)
+                finally:
+                    worker_browser.close()
         except Exception as exc:
-            log(f"  -> error: {exc}")
-        if on_progress:
-            on_progress(i, total, ok)
-        if delay_seconds > 0 and i < total:
-            time.sleep(delay_seconds)
+            log(f"Worker error: {exc}")
+
+    if browser_pool is not None:
+        # Every worker runs on a pooled thread whose browser stays warm between jobs.
+        pool_workers = browser_pool.acquire(workers)
+        workers = len(pool_workers)
+        try:
+            futures = [
+                pool_worker.submit(lambda worker_browser, k=k: work(worker_browser, k))
+                for k, pool_worker in enumerate(pool_workers)
+            ]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as exc:
+                    log(f"Worker error: {exc}")
+        finally:
+            browser_pool.release(pool_workers)
+    else:
+        browser = playwright.chromium.launch(headless=not headed)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for worker_index in range(1, workers):
+                    pool.submit(work_in_thread, worker_index)
+                work(browser, 0)
+        finally:
+            browser.close()
 
-    log(f"Done. Downloaded {ok} of {total}.")
-    context.close()
-    browser.close()
+    if state["cancelled"]:
+        log("  -> cancelled")
+    log(f"Done. Downloaded {state['ok']} of {total}.")
 
 
 def parse_args() -> argparse.Namespace:
@@ -292,6 +615,7 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--headed", action="store_true", help="Run browser in headed mode")
     parser.add_argument("--timeout", type=int, default=15000, help="Download timeout in ms")
     parser.add_argument("--delay", type=int, default=10, help="Delay between suppliers in seconds")
+    parser.add_argument("--workers", type=int, default=1, help="Number of parallel browser workers")
     return parser.parse_args()
 
 
@@ -312,6 +636,7 @@ def main() -> int:
             args.headed,
             args.timeout,
             args.delay,
+            workers=args.workers,
         )
     return 0
 